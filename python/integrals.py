@@ -1,197 +1,262 @@
 import numpy as np
-import math
+import scipy.sparse
+from scipy.special import erf
 
 # Code up the integral equations
-def compute_S_primitive(alpha, beta, R_A, R_B):
-    """Compute the overlap integral between two primitive Gaussians"""
-    #Normalisation of s-type Gaussians
-    N_alpha = (2.0 * alpha / np.pi)**(0.75)
-    N_beta  = (2.0 * beta  / np.pi)**(0.75)
+def boys_F0(T):
+    """
+    Zeroth order Boys function F_0(T) = (1/2) * sqrt(π/T) * erf(sqrt(T))
+    Evaluated elementwise, so a whole array of T values goes through erf in one call
+    """
+    T = np.asarray(T, dtype=float)
+    # Guard the division, small T is replaced by its series expansion anyway
+    T_safe = np.maximum(T, 1e-10)
+    return np.where(T < 1e-10, 1.0 - T / 3.0, 0.5 * np.sqrt(np.pi / T_safe) * erf(np.sqrt(T_safe)))
 
-    S_unnormalised =  (np.pi / (alpha + beta))**(3/2) * np.exp(-alpha * beta / (alpha + beta) * np.sum((R_A - R_B)**2))
+def compute_S_primitive(alpha, beta, R_A, R_B):
+    """
+    Compute the overlap integral between two primitive Gaussians
+    Primitives are unnormalised, the normalisation is folded into the contraction coefficients
+    """
+    S_prim =  (np.pi / (alpha + beta))**(3/2) * np.exp(-alpha * beta / (alpha + beta) * np.sum((R_A - R_B)**2, axis=-1))
 
-    return N_alpha * N_beta * S_unnormalised
+    return S_prim
 
 def compute_T_primitive(alpha, beta, R_A, R_B, S_prim):
     """Compute the kinetic energy integral between two primitive Gaussians"""
     reduced_exp = alpha * beta / (alpha + beta)
-    return reduced_exp * (3 - 2 * reduced_exp * np.sum((R_A - R_B)**2)) * S_prim
+    return reduced_exp * (3 - 2 * reduced_exp * np.sum((R_A - R_B)**2, axis=-1)) * S_prim
 
-def compute_V_nuc_primitive(alpha, beta, R_A, R_B, R_nuc):
+def gaussian_product(alpha, beta, R_A, R_B):
     """
-    Compute nuclear attraction integral for a single nucleus
-    <chi_a | -1/|r-R_nuc| | chi_b>
+    Gaussian product theorem: two Gaussians on A and B combine into one on P
+    Works elementwise on arrays of exponents, with centres carrying a trailing (x,y,z) axis
     """
-    # Normalization
-    N_alpha = (2.0 * alpha / np.pi)**(0.75)
-    N_beta = (2.0 * beta / np.pi)**(0.75)
-    
     zeta = alpha + beta
-    P = (alpha * R_A + beta * R_B) / zeta
-    
-    # Gaussian product overlap factor
-    AB_sq = np.sum((R_A - R_B)**2)
+    P = (alpha[..., None] * R_A + beta[..., None] * R_B) / zeta[..., None]
+    AB_sq = np.sum((R_A - R_B)**2, axis=-1)
     K_AB = np.exp(-alpha * beta / zeta * AB_sq)
-    
+
+    return zeta, P, K_AB
+
+def compute_V_nuc_primitive(zeta, P, K_AB, R_nuc):
+    """
+    Compute nuclear attraction integral for a single nucleus
+    <chi_a | -1/|r-R_nuc| | chi_b>
+    Takes the Gaussian product of the (a,b) pair, so it can be evaluated over whole
+    arrays of primitive pairs and nuclei at once
+    """
     # Distance from product center to nucleus
-    PC_sq = np.sum((P - R_nuc)**2)
-    
-    if PC_sq < 1e-10:
-        V_unnormalised = 2.0 * np.pi / zeta  
-    else:
-        T = zeta * PC_sq
-        F0 = 0.5 * np.sqrt(np.pi / T) * math.erf(np.sqrt(T))
-        V_unnormalised = 2.0 * np.pi / zeta * F0 
-    
-    V_prim = N_alpha * N_beta * K_AB * V_unnormalised
-    
+    PC_sq = np.sum((P - R_nuc)**2, axis=-1)
+
+    F0 = boys_F0(zeta * PC_sq)
+    V_prim = 2.0 * np.pi / zeta * K_AB * F0
+
     return V_prim
 
-def build_S_and_T_matrices(basis_functions):
-    """Build the overlap matrix"""
-    n_basis = len(basis_functions)
-    S = np.zeros((n_basis, n_basis))
-    T = np.zeros((n_basis, n_basis))
+def contraction_matrix(basis):
+    """
+    Build the contraction matrix C[p,i] holding the coefficient of primitive p in
+    basis function i (zero elsewhere), so contracting is just a matrix product
+    """
+    shell_offsets, bf_shell = basis['shell_offsets'], basis['bf_shell']
+    n_prim, n_basis = len(basis['alphas']), len(bf_shell)
+
+    # Every basis function spans all the primitives of its shell
+    prim_id = np.concatenate([np.arange(shell_offsets[s], shell_offsets[s + 1]) for s in bf_shell])
+    bf_id = np.repeat(np.arange(n_basis), np.diff(shell_offsets)[bf_shell])
+
+    C = np.zeros((n_prim, n_basis))
+    C[prim_id, bf_id] = basis['coeffs']
+
+    return C
 
-    for i, basis_i in enumerate(basis_functions):
-        for j, basis_j in enumerate(basis_functions):
-            R_A = basis_i['center']
-            R_B = basis_j['center']
+def build_S_and_T_matrices(basis):
+    """Build the overlap and kinetic energy matrices"""
+    alphas, centers = basis['alphas'], basis['centers']
+    C = contraction_matrix(basis)
 
-            # Loop over every primitve for the contracted Gaussians
-            for alpha, coeff_A in zip(basis_i['exponents'], basis_i['coefficients']):
-                for beta, coeff_B in zip(basis_j['exponents'], basis_j['coefficients']):
+    # Evaluate every primitive pair at once by broadcasting over (alpha, beta)
+    alpha, beta = alphas[:, None], alphas[None, :]
+    R_A, R_B = centers[:, None, :], centers[None, :, :]
 
-                    S_prim = compute_S_primitive(alpha, beta, R_A, R_B)
-                    T_prim = compute_T_primitive(alpha, beta, R_A, R_B, S_prim)
+    S_prim = compute_S_primitive(alpha, beta, R_A, R_B)
+    T_prim = compute_T_primitive(alpha, beta, R_A, R_B, S_prim)
 
-                    # Add weighted contributions to contracted integrals
-                    S[i, j] += coeff_A * coeff_B * S_prim
-                    T[i, j] += coeff_A * coeff_B * T_prim
+    # Contract primitives into the basis functions: S[i,j] = sum_ab C[a,i] C[b,j] S_prim[a,b]
+    S = C.T @ S_prim @ C
+    T = C.T @ T_prim @ C
     return S, T
 
-def build_V_nuc_matrix(basis_functions, atoms):
+def build_V_nuc_matrix(basis, atoms):
     """
     Build nuclear attraction matrix
     V[i,j] = sum over nuclei of -Z * <chi_i | 1/|r-R_nuc| | chi_j>
     """
-    n = len(basis_functions)
-    V_nuc = np.zeros((n, n))
-    
-    for i, basis_i in enumerate(basis_functions):
-        for j, basis_j in enumerate(basis_functions):
-            R_A = basis_i['center']
-            R_B = basis_j['center']
-            
-            # Sum attraction to each nucleus
-            for atom in atoms:
-                R_nuc = atom['coords']
-                Z = 1.0  # Hydrogen ONLY
-                
-                # Contract over primitives
-                for alpha, coeff_A in zip(basis_i['exponents'], basis_i['coefficients']):
-                    for beta, coeff_B in zip(basis_j['exponents'], basis_j['coefficients']):
-                        
-                        S_prim = compute_S_primitive(alpha, beta, R_A, R_B)
-                        V_prim = compute_V_nuc_primitive(alpha, beta, R_A, R_B, R_nuc)
-                        
-                        V_nuc[i, j] += -Z * coeff_A * coeff_B * V_prim
-    
+    alphas, centers = basis['alphas'], basis['centers']
+    C = contraction_matrix(basis)
+
+    # Gaussian products for every primitive pair (a,b)
+    zeta, P, K_AB = gaussian_product(alphas[:, None], alphas[None, :],
+                                     centers[:, None, :], centers[None, :, :])
+
+    R_nuc = np.array([atom['coords'] for atom in atoms])
+    Z = np.ones(len(atoms))  # Hydrogen ONLY
+
+    # Every primitive pair against every nucleus at once, then sum the attraction to each nucleus
+    V_prim = compute_V_nuc_primitive(zeta[:, :, None], P[:, :, None, :], K_AB[:, :, None], R_nuc)
+    V_prim = -V_prim @ Z
+
+    # Contract primitives into the basis functions
+    V_nuc = C.T @ V_prim @ C
+
     return V_nuc
 
-def compute_ERI_primitive(alpha, beta, gamma, delta, R_A, R_B, R_C, R_D):
+def compute_ERI_primitive(zeta, eta, P, Q, K_AB, K_CD):
     """
     Compute (ab|cd) electron repulsion integral between four primitive s-type Gaussians
     Uses the Obara-Saika scheme. Entirely generated from Sonnet 4.5 using reference materials
+    Takes the Gaussian products of the (a,b) and (c,d) pairs, so it can be evaluated
+    over whole arrays of primitive quartets at once
     """
-    # Gaussian product theorem for first pair (a,b)
-    zeta = alpha + beta
-    P = (alpha * R_A + beta * R_B) / zeta
-    AB_sq = np.sum((R_A - R_B)**2)
-    K_AB = np.exp(-alpha * beta / zeta * AB_sq)
-
-    # Gaussian product theorem for second pair (c,d)
-    eta = gamma + delta
-    Q = (gamma * R_C + delta * R_D) / eta
-    CD_sq = np.sum((R_C - R_D)**2)
-    K_CD = np.exp(-gamma * delta / eta * CD_sq)
-
     # Distance between the two Gaussian products
-    PQ_sq = np.sum((P - Q)**2)
+    PQ_sq = np.sum((P - Q)**2, axis=-1)
 
     # Compute the Boys function F_0(x) - for s-orbitals we only need the zeroth order
     rho = zeta * eta / (zeta + eta)
     T = rho * PQ_sq
 
-    if T < 1e-10:
-        F0 = 1.0  # Limit as T -> 0
-    else:
-        # F_0(T) = (1/2) * sqrt(π/T) * erf(sqrt(T))
-        F0 = 0.5 * np.sqrt(np.pi / T) * math.erf(np.sqrt(T))
-
-    # Normalization constants for s-type Gaussians
-    N_alpha = (2.0 * alpha / np.pi)**(0.75)
-    N_beta = (2.0 * beta / np.pi)**(0.75)
-    N_gamma = (2.0 * gamma / np.pi)**(0.75)
-    N_delta = (2.0 * delta / np.pi)**(0.75)
+    F0 = boys_F0(T)
 
     # Full ERI primitive formula
-    ERI_prim = (2.0 * np.pi**2.5 / (zeta * eta * np.sqrt(zeta + eta))) * \
-          K_AB * K_CD * F0 * N_alpha * N_beta * N_gamma * N_delta
+    ERI_prim = (2.0 * np.pi**2.5 / (zeta * eta * np.sqrt(zeta + eta))) * K_AB * K_CD * F0
 
     return ERI_prim
 
-def build_ERI_tensor(basis_functions):
+def build_ERI_tensor(basis, n_jobs=1, screen_tol=1e-12):
     """
     Build the 4D tensor of electron repulsion integrals
     ERI[i,j,k,l] = (ij|kl) in chemist's notation
+    n_jobs > 1 (or -1 for all cores) computes the unique bra shell pairs in parallel, requires joblib
+    Shell quartets with a Cauchy-Schwarz bound below screen_tol are skipped
     """
-    n_basis = len(basis_functions)
-    ERIs = np.zeros((n_basis, n_basis, n_basis, n_basis))
+    alphas, centers = basis['alphas'], basis['centers']
+    shell_offsets, bf_shell = basis['shell_offsets'], basis['bf_shell']
+    n_shells, n_basis = len(shell_offsets) - 1, len(bf_shell)
+    C = contraction_matrix(basis)
+
+    # (ij|kl) = (ji|kl) = (ij|lk) = (kl|ij) etc. so only unique shell pairs s >= t are needed
+    shell_s, shell_t = np.tril_indices(n_shells)
+    n_shell_pairs = len(shell_s)
+
+    # List the primitive pairs (a,b) and basis function pairs (i,j) making up each shell pair,
+    # grouped by shell pair
+    # W[ab,ij] = C[a,i] C[b,j] contracts the primitive pairs of a shell pair into its basis function pairs
+    prim_a, prim_b, bf_i, bf_j, W_blocks = [], [], [], [], []
+    for s, t in zip(shell_s, shell_t):
+        prims_s = np.arange(shell_offsets[s], shell_offsets[s + 1])
+        prims_t = np.arange(shell_offsets[t], shell_offsets[t + 1])
+        bfs_s, bfs_t = np.flatnonzero(bf_shell == s), np.flatnonzero(bf_shell == t)
+        a, b = np.meshgrid(prims_s, prims_t, indexing='ij')
+        i, j = np.meshgrid(bfs_s, bfs_t, indexing='ij')
+        prim_a.append(a.ravel())
+        prim_b.append(b.ravel())
+        bf_i.append(i.ravel())
+        bf_j.append(j.ravel())
+        W_blocks.append(np.einsum('ai,bj->abij', C[np.ix_(prims_s, bfs_s)], C[np.ix_(prims_t, bfs_t)])
+                        .reshape(a.size, i.size))
+    prim_start = np.cumsum([0] + [len(a) for a in prim_a])
+    bf_start = np.cumsum([0] + [len(i) for i in bf_i])
+    prim_a, prim_b = np.concatenate(prim_a), np.concatenate(prim_b)
+    bf_i, bf_j = np.concatenate(bf_i), np.concatenate(bf_j)
+
+    # Gaussian products for every primitive pair, shared between bra and ket
+    zeta, P, K_AB = gaussian_product(alphas[prim_a], alphas[prim_b], centers[prim_a], centers[prim_b])
+
+    # Over all shell pairs W is block diagonal, so keep it sparse for the ket side contraction
+    W = scipy.sparse.block_diag(W_blocks, format='csr')
 
-    for i, basis_i in enumerate(basis_functions):
-        for j, basis_j in enumerate(basis_functions):
-            for k, basis_k in enumerate(basis_functions):
-                for l, basis_l in enumerate(basis_functions):
-                    R_A = basis_i['center']
-                    R_B = basis_j['center']
-                    R_C = basis_k['center']
-                    R_D = basis_l['center']
+    # Cauchy-Schwarz on the contracted integrals: |(ij|kl)| <= sqrt((ij|ij)) sqrt((kl|kl)).
+    # Q[st] bounds every basis function pair in shell pair st, from the diagonal (st|st) blocks
+    Q_shell = np.zeros(n_shell_pairs)
+    for st in range(n_shell_pairs):
+        bra = slice(prim_start[st], prim_start[st + 1])
+        W_st = W_blocks[st]
+        ERI_prim = compute_ERI_primitive(
+            zeta[bra, None], zeta[None, bra],
+            P[bra, None, :], P[None, bra, :],
+            K_AB[bra, None], K_AB[None, bra],
+        )
+        Q_shell[st] = np.sqrt(np.max(np.diagonal(W_st.T @ ERI_prim @ W_st)))
+    # Shell pair that each primitive pair belongs to
+    prim_shell_pair = np.repeat(np.arange(n_shell_pairs), np.diff(prim_start))
 
-                    # Contract over all primitives
-                    for alpha, coeff_A in zip(basis_i['exponents'], basis_i['coefficients']):
-                        for beta, coeff_B in zip(basis_j['exponents'], basis_j['coefficients']):
-                            for gamma, coeff_C in zip(basis_k['exponents'], basis_k['coefficients']):
-                                for delta, coeff_D in zip(basis_l['exponents'], basis_l['coefficients']):
+    def compute_ERI_row(st):
+        """(ij|kl) for i,j in shell pair st against every ket shell pair up to it"""
+        bra = slice(prim_start[st], prim_start[st + 1])
 
-                                    ERI_prim = compute_ERI_primitive(
-                                        alpha, beta, gamma, delta,
-                                        R_A, R_B, R_C, R_D
-                                    )
+        # Only evaluate the ket shell pairs that survive screening, the skipped blocks stay zero
+        ket = np.flatnonzero(Q_shell[st] * Q_shell[prim_shell_pair[:prim_start[st + 1]]] >= screen_tol)
 
-                                    ERIs[i, j, k, l] += coeff_A * coeff_B * coeff_C * coeff_D * ERI_prim
+        ERI_prim = compute_ERI_primitive(
+            zeta[bra, None], zeta[None, ket],
+            P[bra, None, :], P[None, ket, :],
+            K_AB[bra, None], K_AB[None, ket],
+        )
+
+        # Contract the bra primitives with its own block, then the ket primitives of every shell pair in one go
+        ERI_half = W_blocks[st].T @ ERI_prim
+        return (W[ket, :bf_start[st + 1]].T @ ERI_half.T).T
+
+    # Rows are independent, so they can be farmed out across cores with joblib.
+    # joblib is optional (it isn't available for the Pyodide web demo), so only import it when asked
+    if n_jobs == 1:
+        ERI_rows = [compute_ERI_row(st) for st in range(n_shell_pairs)]
+    else:
+        from joblib import Parallel, delayed
+        # Threads rather than processes: NumPy releases the GIL and the pair arrays aren't copied
+        ERI_rows = Parallel(n_jobs=n_jobs, prefer='threads')(
+            delayed(compute_ERI_row)(st) for st in range(n_shell_pairs)
+        )
+
+    # Index the unique basis function pairs, (i,j) and (j,i) share an index
+    pair_i, pair_j = np.tril_indices(n_basis)
+    n_pairs = len(pair_i)
+    pair_index = np.zeros((n_basis, n_basis), dtype=int)
+    pair_index[pair_i, pair_j] = np.arange(n_pairs)
+    pair_index[pair_j, pair_i] = np.arange(n_pairs)
+    bf_pair = pair_index[bf_i, bf_j]
+
+    # Each canonical block also fills its (kl|ij) transpose
+    ERI_pairs = np.zeros((n_pairs, n_pairs))
+    for st, ERI_row in enumerate(ERI_rows):
+        bra_pairs = bf_pair[bf_start[st]:bf_start[st + 1]]
+        ket_pairs = bf_pair[:bf_start[st + 1]]
+        ERI_pairs[bra_pairs[:, None], ket_pairs[None, :]] = ERI_row
+        ERI_pairs[ket_pairs[:, None], bra_pairs[None, :]] = ERI_row.T
+
+    # Scatter the 8 symmetric copies back out to the full tensor
+    ERIs = ERI_pairs[pair_index[:, :, None, None], pair_index[None, None, :, :]]
 
     return ERIs
 
-def build_G_matrix(D, ERIs):
+def build_G_tensor(ERIs):
+    """
+    Fold the Coulomb and exchange integrals into one tensor, once before the SCF loop
+    G_tensor[μ,ν,λ,σ] = (μν|λσ) - 0.5*(μλ|νσ)
+    """
+    return ERIs - 0.5 * ERIs.transpose(0, 2, 1, 3)
+
+def build_G_matrix(D, G_tensor):
     """
     Build the two-electron part of the Fock matrix: G = J - K
     J is the Coulomb term, K is the exchange term
 
     G[μ,ν] = Σ_λσ D[λ,σ] * [(μν|λσ) - 0.5*(μλ|νσ)]
-    """
-    n = D.shape[0]
-    G = np.zeros((n, n))
-
-    for mu in range(n):
-        for nu in range(n):
-            for lam in range(n):
-                for sig in range(n):
-                    # Coulomb term: (μν|λσ)
-                    J = ERIs[mu, nu, lam, sig]
-                    # Exchange term: (μλ|νσ)
-                    K = ERIs[mu, lam, nu, sig]
 
-                    G[mu, nu] += D[lam, sig] * (J - 0.5 * K)
+    With J and K already folded together by build_G_tensor this is a single
+    contraction over λσ, i.e. one matrix-vector product
+    """
+    G = np.tensordot(G_tensor, D, axes=([2, 3], [0, 1]))
 
     return G
@@ -1,5 +1,6 @@
 import basis_set_exchange
 import numpy as np
+import scipy.linalg
 import json
 import logging
 import time
@@ -10,6 +11,7 @@ from integrals import (
     build_S_and_T_matrices,
     build_V_nuc_matrix,
     build_ERI_tensor,
+    build_G_tensor,
     build_G_matrix,
 )
 
@@ -47,25 +49,42 @@ def main(R=1.4, basis_set_name="STO-3G"):
     ## Basis sets in searchable JSON form!
 
     ## Get a list of exponents (alpha values for the primitives) and contraction coefficients (d values)
-    basis_functions = []
+    ## Stored as flat arrays (struct-of-arrays). Each shell on each atom stores its primitives once,
+    ## shell_offsets[s]:shell_offsets[s+1], and every contraction of that shell is a basis function
+    ## over those same primitives, with coefficients concatenated in all_coeffs
+    all_alphas, all_centers, all_coeffs = [], [], []
+    shell_offsets = [0]
+    bf_shell = []
     n_shells = basis_set_data["elements"]["1"]["electron_shells"]
     for shell in n_shells:
         exponents = np.array([float(exp) for exp in shell["exponents"]])
 
+        # One shell per atom
+        first_shell = len(shell_offsets) - 1
+        for atom in atoms:
+            all_alphas.append(exponents)
+            all_centers.append(np.tile(atom["coords"], (len(exponents), 1)))
+            shell_offsets.append(shell_offsets[-1] + len(exponents))
+
         for contraction in shell["coefficients"]:
             contraction_coeffs = np.array([float(coeff) for coeff in contraction])
+            # Fold the s-type Gaussian normalisation (2α/π)^(3/4) into the coefficients once
+            contraction_coeffs = contraction_coeffs * (2.0 * exponents / np.pi) ** 0.75
 
             # Store the basis function data per atom
-            for atom in atoms:
-                basis_functions.append(
-                    {
-                        "center": atom["coords"],
-                        "exponents": exponents,
-                        "coefficients": contraction_coeffs,
-                    }
-                )
-
-    n_basis = len(basis_functions)
+            for atom_idx, atom in enumerate(atoms):
+                bf_shell.append(first_shell + atom_idx)
+                all_coeffs.append(contraction_coeffs)
+
+    basis = {
+        "alphas": np.concatenate(all_alphas),
+        "centers": np.concatenate(all_centers),
+        "coeffs": np.concatenate(all_coeffs),
+        "shell_offsets": np.array(shell_offsets),
+        "bf_shell": np.array(bf_shell),
+    }
+
+    n_basis = len(bf_shell)
     logger.debug(f"exponents: {exponents}")
     logger.debug(f"contraction_coeffs: {contraction_coeffs}")
 
@@ -78,29 +97,37 @@ def main(R=1.4, basis_set_name="STO-3G"):
     D = np.zeros((n_basis, n_basis))
 
     ## Nuclear attraction Potential Matrix (ultra simplified dummy, no integrals implemented)
-    V_nuc = build_V_nuc_matrix(basis_functions, atoms)
+    V_nuc = build_V_nuc_matrix(basis, atoms)
     logger.info(f"V_nuc nuclear attraction matrix:\n {V_nuc}")
 
     # Populate the one-electron Overlap and Kinetic Energy Matrices (refer to subfunctions in integrals.py)
-    S, T = build_S_and_T_matrices(basis_functions)
+    S, T = build_S_and_T_matrices(basis)
     logger.info(f"S overlap matrix:\n {S}")
     logger.info(f"T kinetic energy matrix:\n {T}")
 
     ## Build the ERIs once before SCF loop
     logger.info("Computing electron repulsion integrals...")
     eri_start = time.time()
-    ERIs = build_ERI_tensor(basis_functions)
+    ERIs = build_ERI_tensor(basis)
     eri_end = time.time()
     logger.info(f"ERIs computed in {eri_end - eri_start:.3f} seconds")
     logger.debug(f"ERI[0,0,0,0] = {ERIs[0,0,0,0]:.6f}")  # Should be ~0.77 for H2/STO-3G
     logger.debug(f"ERI[0,0,1,1] = {ERIs[0,0,1,1]:.6f}")  # Should be ~0.44
 
+    # Combine the Coulomb and exchange integrals once so each G build is a single contraction
+    G_tensor = build_G_tensor(ERIs)
+
     H_core = T + V_nuc
     logger.info(f"H_core matrix:\n{H_core}")
 
-    # Diagonalize H_core directly
+    ## Calculate Orthogonalisation Matrix once, S is fixed across the SCF iterations
     s_eigvals, s_eigvecs = np.linalg.eigh(S)
-    X = s_eigvecs @ np.diag(s_eigvals ** (-0.5)) @ s_eigvecs.T
+    logger.debug(f"S matrix eigenvalues: {s_eigvals}")
+    # Scale the eigenvector columns directly rather than multiplying by a diagonal matrix
+    X = (s_eigvecs * s_eigvals**-0.5) @ s_eigvecs.T
+    logger.debug(f"X orthogonalisation matrix:\n {X}")
+
+    # Diagonalize H_core directly
     H_core_prime = X.T @ H_core @ X
     epsilon_core, C_core_prime = np.linalg.eigh(H_core_prime)
     C_core = X @ C_core_prime
@@ -115,8 +142,30 @@ def main(R=1.4, basis_set_name="STO-3G"):
     # Set up the SCF loop
     max_iter = 50
     epsilon_tol = 1e-6
+    commutator_tol = 1e-5
     converged = False
     E_old = 0.0
+
+    # Number of doubly occupied orbitals
+    num_electrons = len(
+        atoms
+    )  # Assuming each H contributes 1 electron. Not implementing proper count
+    if num_electrons % 2 != 0:
+        logger.error(
+            "Number of electrons is odd, cannot proceed with restricted HF."
+        )
+    num_occ = num_electrons // 2
+
+    # Preallocate the per-iteration matrices once and reuse them in place
+    F = np.empty((n_basis, n_basis))
+    D_new = np.empty((n_basis, n_basis))
+    work = np.empty((n_basis, n_basis))
+
+    # Pulay DIIS: extrapolate F from the last few Fock matrices and their error vectors
+    diis_size = 8
+    diis_max_cond = 1e10
+    F_history = []
+    e_history = []
     energy_history = [] 
 
     logger.info("\n🔁 Starting SCF iterations...")
@@ -124,53 +173,73 @@ def main(R=1.4, basis_set_name="STO-3G"):
     for iteration in range(max_iter):
 
         ## Build the Fock Matrix
-        G = build_G_matrix(D, ERIs)
+        G = build_G_matrix(D, G_tensor)
         logger.debug(f"G matrix:\n{G}")
-        F = T + V_nuc + G
-        logger.debug(f"H_core:\n{T + V_nuc}")
-
-        ## Calculate Orthogonalisation Matrix
-        s_eigvals, s_eigvecs = np.linalg.eigh(S)
-        logger.debug(f"S matrix eigenvalues: {s_eigvals}")
-        X = s_eigvecs @ np.diag(s_eigvals**-0.5) @ s_eigvecs.T
-        logger.debug(f"X orthogonalisation matrix:\n {X}")
-
-        ## Transform Fock Matrix into new basis
-        F_prime = X.T @ F @ X
-        logger.debug(f"F' transformed Fock matrix:\n {F_prime}")
-
-        # Update Coefficient Matrix
-        epsilon, C_prime = np.linalg.eigh(F_prime)
-        logger.debug(f"C_prime before transform:\n{C_prime}")
-        logger.info(f"epsilon orbital energies:\n {epsilon}")
-
-        C = X @ C_prime
-        logger.debug(f"C coefficient matrix:\n {C}")
-
-        # Update Density Matrix
-        num_electrons = len(
-            atoms
-        )  # Assuming each H contributes 1 electron. Not implementing proper count
-        if num_electrons % 2 != 0:
-            logger.error(
-                "Number of electrons is odd, cannot proceed with restricted HF."
-            )
-        num_occ = num_electrons // 2
+        np.add(H_core, G, out=F)
+
+        # Orthogonalised commutator FDS - SDF vanishes at self-consistency, SDF is just (FDS)^T as F, D, S
+        # are symmetric. Unlike the change in D it is basis invariant, so near-null directions of S don't swamp it
+        FDS = F @ D @ S
+        e = X.T @ (FDS - FDS.T) @ X
+        rms_e = np.linalg.norm(e) / n_basis
+
+        ## DIIS extrapolation
+        # The zero starting density gives a zero error, which would pin DIIS to H_core, so skip it
+        if iteration > 0:
+            F_history.append(F.copy())
+            e_history.append(e)
+            if len(F_history) > diis_size:
+                F_history.pop(0)
+                e_history.pop(0)
+
+        F_diis = F
+        if len(F_history) > 1:
+            # B[i,j] = Tr(e_i^T e_j). Drop the oldest vectors while they are close to linearly
+            # dependent (small molecules only have a few independent error directions)
+            B_errors = np.einsum('aij,bij->ab', e_history, e_history)
+            while len(F_history) > 2 and np.linalg.cond(B_errors) > diis_max_cond:
+                F_history.pop(0)
+                e_history.pop(0)
+                B_errors = B_errors[1:, 1:]
+            n_diis = len(F_history)
+
+            # Solve [[B, -1], [-1, 0]] [c, λ] = [0, -1] for the coefficients c
+            B = -np.ones((n_diis + 1, n_diis + 1))
+            B[n_diis, n_diis] = 0.0
+            B[:n_diis, :n_diis] = B_errors
+            rhs = np.zeros(n_diis + 1)
+            rhs[n_diis] = -1.0
+            # Least squares in case the last two errors are still (numerically) parallel
+            diis_coeffs = np.linalg.lstsq(B, rhs, rcond=None)[0][:n_diis]
+            F_diis = sum(c * F_i for c, F_i in zip(diis_coeffs, F_history))
+
+        # Update Coefficient Matrix by solving FC = SCε directly as a generalized eigenproblem
+        # Only the occupied orbitals enter the density, so only extract the lowest num_occ of them
+        epsilon_occ, C_occ = scipy.linalg.eigh(
+            F_diis, S, subset_by_index=[0, num_occ - 1], driver="gvx"
+        )
+        logger.info(f"occupied orbital energies:\n {epsilon_occ}")
+        logger.debug(f"C_occ occupied coefficients:\n {C_occ}")
 
-        D_new = 2 * C[:, :num_occ] @ C[:, :num_occ].T
+        # D = 2 C_occ C_occ^T, written straight into the preallocated buffer
+        np.matmul(C_occ, C_occ.T, out=D_new)
+        D_new *= 2.0
         logger.debug(f"D_new density matrix:\n {D_new}")
 
-        E_elec = 0.5 * np.trace(D_new @ (T + V_nuc + F))
+        # Tr(D @ M) for symmetric D and M is just the elementwise sum, no matrix product needed
+        np.add(H_core, F, out=work)
+        work *= D_new
+        E_elec = 0.5 * np.sum(work)
         E_total = E_elec + E_nuc_repulsion
         energy_history.append(E_total)
         delta_E = abs(E_total - E_old)
 
         logger.info(
-            f"\nIteration {iteration + 1}: E = {E_total:.6f} Ha, ΔE = {delta_E:.2e}\n"
+            f"\nIteration {iteration + 1}: E = {E_total:.6f} Ha, ΔE = {delta_E:.2e}, RMS [F,D] = {rms_e:.2e}\n"
         )
 
-        # Check for SCF convergence
-        if delta_E < epsilon_tol:
+        # Check for SCF convergence on both the energy and the FDS - SDF commutator
+        if delta_E < epsilon_tol and rms_e < commutator_tol:
             scf_end = time.time()
             logger.info(
                 f"\n✓ SCF Converged in {iteration+1} iterations! \n Time taken: {scf_end - scf_start:.3f} seconds"
@@ -179,11 +248,15 @@ def main(R=1.4, basis_set_name="STO-3G"):
             break
         else:
             E_old = E_total
-            D = D_new
+            # Swap the buffers rather than copying, the old D is overwritten next iteration
+            D, D_new = D_new, D
 
     if not converged:
         logger.info("\n✗ SCF did not converge within the maximum number of iterations.")
 
+    # The SCF only needed the occupied orbitals, get the full spectrum of the final Fock matrix to report
+    epsilon = scipy.linalg.eigvalsh(F_diis, S)
+
     logger.info(f"Final SCF Energy: {E_total:.6f} Ha")
     logger.info(f"Final orbital energies: {epsilon}")
 